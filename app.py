@@ -3,40 +3,141 @@ import pandas as pd
 import base64
 import traceback
 import io
-from utils import create_conversational_chain
+import html
+import logging
+import numbers
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from openpyxl import Workbook
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from utils import create_conversational_chain, run_query
+
+# Errors go to error_log.txt through a single handler that stays open
+logging.basicConfig(filename="error_log.txt", level=logging.ERROR)
+
+# Chat bubble markup for each history role, filled with the message text
+MESSAGE_TEMPLATES = {
+    "user": "<div style='text-align: right; padding: 10px; background: #d9f1ff; border-radius: 10px; margin: 5px 0; color: #000000; font-weight: bold;'>{}</div>",
+    "bot": "<div style='text-align: left; padding: 10px; background: #e0f7da; border-radius: 10px; margin: 5px 0; color: #000000; font-weight: bold;'>{}</div>",
+}
+
+@st.cache_resource
+def _chatbot_header_html():
+    """Builds the chatbot header, with the image inlined as a data URI, once per process."""
+    with open("195.png", "rb") as img_file:
+        encoded_image = base64.b64encode(img_file.read()).decode()
+
+    return f"""
+        <div style='text-align: center;'>
+            <img src='data:image/png;base64,{encoded_image}' width='150'/>
+            <h1 style='color: #4CAF50;'>AI-Powered Chatbot for Clickhouse</h1>
+            <p>Ask me anything, and I'll do my best to help!</p>
+        </div>
+        <hr>
+    """
+
+def _from_list(response):
+    """Builds a DataFrame from a list, based on the type of its first item."""
+    if isinstance(response[0], tuple):
+        return pd.DataFrame.from_records(response)
+    if isinstance(response[0], dict):
+        return pd.DataFrame(response)
+    return pd.DataFrame({'Response': response})
+
+# Maps a response type to the function that turns it into a DataFrame
+_BUILDERS = {
+    pd.DataFrame: lambda r: r,
+    list: _from_list,
+    dict: lambda r: pd.DataFrame([r]),
+}
+
+def to_dataframe(response):
+    """Converts any type of response into a DataFrame."""
+    return _BUILDERS.get(type(response), lambda r: pd.DataFrame({'Response': [r]}))(response)
+
+def is_scalar_result(response):
+    """Checks whether a response is a single value (e.g. SELECT count())."""
+    return isinstance(response, pd.DataFrame) and response.shape == (1, 1)
 
 def format_and_display_response(response):
     """Converts any type of response into a structured table format."""
-    if not response:
+    if response is None or len(response) == 0:
         st.warning("No data available.")
         return
 
-    if isinstance(response, list):
-        if isinstance(response[0], tuple):
-            df = pd.DataFrame(response)
-        elif isinstance(response[0], dict):
-            df = pd.DataFrame(response)
-        else:
-            df = pd.DataFrame({'Response': response})
-    elif isinstance(response, dict):
-        df = pd.DataFrame([response])
-    else:
-        df = pd.DataFrame({'Response': [response]})
-
-    st.dataframe(df)
-    st.session_state['export_data'] = df
+    # Set before any early return so the download never serves a stale result
+    st.session_state['export_data'] = response
+
+    # A single value is posted in the chat instead, so it doesn't need a table
+    if is_scalar_result(response):
+        return
+
+    st.dataframe(to_dataframe(response))
+
+# Cell value types openpyxl writes natively; anything else is written as text
+_EXCEL_TYPES = (numbers.Real, Decimal, date, time, timedelta)
+
+def _excel_value(value):
+    """Converts a cell value into one openpyxl can write, as to_excel used to."""
+    # Missing values (NaN, pd.NA, NaT) become empty cells
+    if pd.api.types.is_scalar(value) and pd.isna(value):
+        return None
+    if isinstance(value, str):
+        return ILLEGAL_CHARACTERS_RE.sub("", value)
+    if isinstance(value, _EXCEL_TYPES):
+        # openpyxl rejects tz-aware values, so keep the wall-clock time
+        if isinstance(value, (datetime, time)) and value.tzinfo is not None:
+            return value.replace(tzinfo=None)
+        return value
+    # UUID, IPv4Address, Array (list), Map (dict), ...
+    return ILLEGAL_CHARACTERS_RE.sub("", str(value))
+
+# The cache is shared by all sessions, so only keep a few recent workbooks
+@st.cache_data(show_spinner=False, max_entries=8)
+def _excel_bytes(response):
+    """Builds the Excel workbook for a response; identical responses reuse the cached bytes."""
+    df = to_dataframe(response)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Sheet1')
+    ws.append([str(col) for col in df.columns])
+    for row in df.itertuples(index=False, name=None):
+        ws.append([_excel_value(v) for v in row])
+    output = io.BytesIO()
+    wb.save(output)
+    return output.getvalue()
 
 def export_to_excel():
     """Exports the data to an Excel file and provides a download button."""
     if 'export_data' in st.session_state:
-        df = st.session_state['export_data']
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            df.to_excel(writer, index=False, sheet_name='Sheet1')
-        output.seek(0)
-        b64 = base64.b64encode(output.read()).decode()
-        href = f'<a href="data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,{b64}" download="query_results.xlsx">Download Excel File</a>'
-        st.sidebar.markdown(href, unsafe_allow_html=True)
+        try:
+            data = _excel_bytes(st.session_state['export_data'])
+        except Exception as e:
+            st.sidebar.error(f"Excel export failed: {str(e)}")
+            logging.exception("Excel export failed")
+            return
+
+        st.sidebar.download_button(
+            label="Download Excel File",
+            data=data,
+            file_name="query_results.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        )
+
+def _message_html(role, text):
+    """Fills the role's bubble template with the escaped message text."""
+    # Line breaks become <br> so a blank line can't end the HTML block early
+    return MESSAGE_TEMPLATES[role].format(html.escape(text).replace("\n", "<br>"))
+
+@st.fragment
+def render_history():
+    """Renders the whole chat history as a single markdown block."""
+    history_html = "".join(_message_html(msg["role"], msg["text"]) for msg in st.session_state["history"])
+    st.markdown(history_html, unsafe_allow_html=True)
+
+def add_message(role, text):
+    """Appends a message to the chat history and renders it right away."""
+    st.session_state["history"].append({"role": role, "text": text})
+    st.markdown(_message_html(role, text), unsafe_allow_html=True)
 
 def main():
     """Main function for the Streamlit chatbot app."""
@@ -44,48 +145,29 @@ def main():
 
     # Sidebar Configuration
     st.sidebar.title("Settings")
-    st.sidebar.info("Connecting to the database and initializing the AI model...")
+    status = st.sidebar.empty()
+    status.info("Connecting to the database and initializing the AI model...")
+
+    # Chatbot Header with Image, shown before the (possibly slow) connection
+    st.markdown(_chatbot_header_html(), unsafe_allow_html=True)
 
     try:
-        db_chain, chain = create_conversational_chain()
-        st.sidebar.success("Connected Successfully!")
+        # The chain carries conversation memory, so keep one per session
+        if "db_chain" not in st.session_state:
+            with st.spinner("Connecting..."):
+                st.session_state["db_chain"] = create_conversational_chain()
+        db_chain = st.session_state["db_chain"]
+        status.success("Connected Successfully!")
     except Exception as e:
-        st.sidebar.error(f"Connection failed: {str(e)}")
+        status.error(f"Connection failed: {str(e)}")
         return
 
-    # Load chatbot image
-    if "chatbot_image" not in st.session_state:
-        with open("195.png", "rb") as img_file:
-            encoded_image = base64.b64encode(img_file.read()).decode()
-            st.session_state["chatbot_image"] = encoded_image
-
-    # Chatbot Header with Image
-    st.markdown(f"""
-        <div style='text-align: center;'>
-            <img src='data:image/png;base64,{st.session_state["chatbot_image"]}' width='150'/>
-            <h1 style='color: #4CAF50;'>AI-Powered Chatbot for Clickhouse</h1>
-            <p>Ask me anything, and I'll do my best to help!</p>
-        </div>
-        <hr>
-    """, unsafe_allow_html=True)
-
     # Chat history initialization
     if "history" not in st.session_state:
         st.session_state["history"] = []
 
     # Chat Display Section
-    chat_container = st.container()
-    with chat_container:
-        for msg in st.session_state["history"]:
-            align = "right" if "You:" in msg else "left"
-            bg_color = "#d9f1ff" if "You:" in msg else "#e0f7da"
-
-            st.markdown(f"""
-                <div style='text-align: {align}; padding: 10px; background: {bg_color}; 
-                border-radius: 10px; margin: 5px 0; color: #000000; font-weight: bold;'>
-                    {msg}
-                </div>
-            """, unsafe_allow_html=True)
+    render_history()
 
     # User Input Section
     user_input = st.text_area("Type your message here:", key="user_input")
@@ -99,33 +181,36 @@ def main():
     if submit_button and user_input.strip():
         with st.spinner("Thinking..."):
             try:
-                response = db_chain.run(user_input)
-                st.session_state["history"].append(f"**You:** {user_input}")
+                # The chain only writes the SQL; ClickHouse runs it natively
+                sql = db_chain.run(user_input)
+                response = run_query(sql)
+                add_message("user", user_input)
 
-                if isinstance(response, (list, tuple, dict)) and response:
-                    st.session_state["history"].append("**Bot:** (See table below)")
-                    format_and_display_response(response)
+                if response.empty:
+                    add_message("bot", "No data found")
                 else:
-                    st.session_state["history"].append(f"**Bot:** {response or 'No data found'}")
+                    if is_scalar_result(response):
+                        add_message("bot", str(response.iat[0, 0]))
+                    else:
+                        add_message("bot", "(See table below)")
+                    format_and_display_response(response)
 
             except Exception as e:
                 error_message = f"❌ Error: {str(e)}"
                 error_traceback = traceback.format_exc()
-                st.session_state["history"].append(f"**Bot:** {error_message}")
+                add_message("bot", error_message)
 
                 st.error(error_message)
                 with st.expander("Show Error Details"):
                     st.code(error_traceback, language="python")
 
                 # Log error to a file
-                with open("error_log.txt", "a") as log_file:
-                    log_file.write(f"\n{error_traceback}\n")
-
-        st.rerun()
+                logging.exception("Query failed")
 
     # Clear Chat Button
     if st.sidebar.button("Clear Chat"):
         st.session_state["history"] = []
+        db_chain.memory.clear()
         st.rerun()
     
     # Export Button in Sidebar
@@ -2,15 +2,41 @@ from langchain_community.utilities import SQLDatabase
 from langchain_core.prompts import PromptTemplate
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_experimental.sql.base import SQLDatabaseChain
-from langchain_core.output_parsers import StrOutputParser
 from langchain.chains import LLMChain
-from langchain.memory import ConversationBufferMemory
+from langchain.memory import ConversationBufferWindowMemory
 
 import configparser
 import os
 import clickhouse_connect
+from clickhouse_connect.driver import httputil
+import streamlit as st
 from sqlalchemy import create_engine
 
+# Shared HTTP pool so ClickHouse clients reuse keep-alive connections
+_POOL_MGR = httputil.get_pool_manager(maxsize=16, num_pools=4)
+
+SQL_PROMPT_TEMPLATE = """
+Only use the following tables:
+{table_info}
+Question: {input}
+
+Given an input question, first create a syntactically correct
+{dialect} query to run.
+
+Relevant pieces of previous conversation:
+{history}
+
+(You do not need to use these pieces of information if not relevant)
+Don't include ```, ```sql and \n in the output.
+"""
+
+# The prompt never changes, so build it once
+PROMPT = PromptTemplate(
+    input_variables=["input", "table_info", "dialect", "history"],
+    template=SQL_PROMPT_TEMPLATE,
+)
+
+@st.cache_data
 def read_properties_file(file_path):
     """Reads database credentials and API key from the properties file."""
     if not os.path.exists(file_path):
@@ -62,6 +88,22 @@ def get_llm(gemini_api_key):
         print(f"❌ Error initializing LLM: {e}")
         raise e
 
+# Set once the required table has been found, so the check runs once per process
+_tables_validated = False
+
+def validate_tables():
+    """Checks that the 'combined_definition_map' table exists in db_name (once per process)."""
+    global _tables_validated
+    if _tables_validated:
+        return
+
+    # Validate if 'combined_definition_map' exists (a single 0/1 row), using the
+    # shared client so the check runs against the configured database
+    if not get_clickhouse_client().query("EXISTS TABLE combined_definition_map").result_rows[0][0]:
+        raise ValueError("❌ Table 'combined_definition_map' does not exist in the database.")
+
+    _tables_validated = True
+
 def db_connection(db_host, db_port, db_user, db_password, db_name):
     """Establishes a connection to ClickHouse using SQLAlchemy."""
     connection_string = f"clickhouse+http://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
@@ -71,15 +113,7 @@ def db_connection(db_host, db_port, db_user, db_password, db_name):
         connection = engine.connect()
         print("✅ Connected to ClickHouse successfully")
 
-        # Fetch table names
-        client = clickhouse_connect.get_client(host=db_host, port=db_port, username=db_user, password=db_password)
-        tables = client.query("SHOW TABLES").result_rows
-        print("Available Tables:", tables)
-
-        # Validate if 'combined_definition_map' exists
-        table_names = [t[0] for t in tables]  
-        if 'combined_definition_map' not in table_names:
-            raise ValueError(f"❌ Table 'combined_definition_map' does not exist in the database. Available tables: {table_names}")
+        validate_tables()
 
         return SQLDatabase(engine)
     
@@ -87,59 +121,66 @@ def db_connection(db_host, db_port, db_user, db_password, db_name):
         print(f"❌ Connection failed: {e}")
         raise e
 
+@st.cache_resource(show_spinner=False)
+def _build_chain():
+    """Creates the LLM and database handles, shared across reruns and sessions."""
+    # Fetch properties from the config file
+    config = get_property()
+
+    # Get the LLM instance
+    llm = get_llm(config["gemini_api_key"])
+
+    # Get the DB connection
+    db = db_connection(
+        config["db_host"],
+        config["db_port"],
+        config["db_user"],
+        config["db_password"],
+        config["db_name"]
+    )
+
+    return llm, db
+
+@st.cache_resource(show_spinner=False)
+def get_clickhouse_client():
+    """Creates the clickhouse_connect client used to run generated SQL, shared across sessions."""
+    config = get_property()
+    # No session id, so concurrent Streamlit sessions can query through the same client
+    return clickhouse_connect.get_client(
+        host=config["db_host"],
+        port=config["db_port"],
+        username=config["db_user"],
+        password=config["db_password"],
+        database=config["db_name"],
+        pool_mgr=_POOL_MGR,
+        autogenerate_session_id=False
+    )
+
+def run_query(sql):
+    """Runs a SQL query on ClickHouse and returns the result as a DataFrame."""
+    return get_clickhouse_client().query_df(sql)
+
 def create_conversational_chain():
+    """Builds a SQL chain with its own conversation memory on top of the cached LLM and DB."""
     try:
-        # Fetch properties from the config file
-        config = get_property()
-
-        # Get the LLM instance
-        llm = get_llm(config["gemini_api_key"])
-
-        # Get the DB connection
-        db = db_connection(
-            config["db_host"],
-            config["db_port"],
-            config["db_user"],
-            config["db_password"],
-            config["db_name"]
-        )
+        llm, db = _build_chain()
 
-        sql_prompt_template = """
-        Only use the following tables:
-        {table_info}
-        Question: {input}
-
-        Given an input question, first create a syntactically correct
-        {dialect} query to run.
-        
-        Relevant pieces of previous conversation:
-        {history}
-
-        (You do not need to use these pieces of information if not relevant)
-        Don't include ```, ```sql and \n in the output.
-        """
-        prompt = PromptTemplate(
-            input_variables=["input", "table_info", "dialect", "history"],
-            template=sql_prompt_template,
-        )
-        memory = ConversationBufferMemory(memory_key="history")
+        # Only the last few exchanges go into {history}, keeping prompts bounded
+        memory = ConversationBufferWindowMemory(memory_key="history", k=5)
 
         db_chain = SQLDatabaseChain.from_llm(
-            llm, db, memory=memory, prompt=prompt, return_direct=True, verbose=True
+            llm, db, memory=memory, prompt=PROMPT, return_sql=True, verbose=True
         )
 
-        output_parser = StrOutputParser()
-        chain = llm | output_parser
-
     except Exception as e:
         print(f"❌ Error in creating conversational chain: {e}")
         raise e
     
-    return db_chain, chain
+    return db_chain
 
 # Entry Point
 if __name__ == "__main__":
     try:
-        db_chain, chain = create_conversational_chain()
+        db_chain = create_conversational_chain()
     except Exception as e:
         print(f"❌ Execution failed: {e}")